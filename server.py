@@ -1,26 +1,65 @@
 import os
-import re
-import json
-import threading
-from typing import Dict, List, Any
-import requests
-import time
+import atexit
+import asyncio
+import logging
+import logging.handlers
+import mmap
+import queue
+import secrets
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from itertools import accumulate
+from typing import Deque, Dict, List, Any, Sequence
+from urllib.parse import quote_plus
+import aiofiles
+import httpx
+import orjson
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from selectolax.parser import HTMLParser
 from dotenv import load_dotenv
 
 # Load environment variables from .env
 load_dotenv()
 
+# Logging goes through a queue so coroutines never block on stdout; a background
+# listener thread does the actual writes.
+_log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger = logging.getLogger("chatbot")
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.propagate = False
+
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY") or os.getenv("API_KEY")
 OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "deepseek/deepseek-chat-v3.1:free")
 OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
 
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads"))
 os.makedirs(UPLOAD_DIR, exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB per read when streaming uploads to disk
+# Upload constraints (configurable via env), parsed once at startup
+try:
+    MAX_UPLOAD_SIZE_MB = max(1, int(os.getenv("MAX_UPLOAD_SIZE_MB", "10")))
+except Exception:
+    MAX_UPLOAD_SIZE_MB = 10
+MAX_UPLOAD_BYTES = MAX_UPLOAD_SIZE_MB * 1024 * 1024
+ALLOWED_UPLOAD_TYPES = {
+    t.strip().lower()
+    for t in os.getenv(
+        "ALLOWED_UPLOAD_TYPES",
+        # common images and office/pdf/plain text
+        "image/jpeg,image/png,image/gif,application/pdf,application/vnd.openxmlformats-officedocument.wordprocessingml.document,application/msword,text/plain"
+    ).split(",")
+    if t.strip()
+}
 
 TAVILY_API_KEY = os.getenv("TAVILY_API_KEY", "").strip()
 
@@ -29,8 +68,16 @@ TAVILY_API_KEY = os.getenv("TAVILY_API_KEY", "").strip()
 MAX_TURNS = int(os.getenv("MAX_TURNS", "10"))  # number of user-assistant exchanges to keep
 # Additionally cap the total characters included from history to avoid very large prompts.
 MAX_PROMPT_CHARS = int(os.getenv("MAX_PROMPT_CHARS", "6000"))
+# Cap on sessions kept in memory; the least recently used one is evicted past this.
+MAX_SESSIONS = max(1, int(os.getenv("MAX_SESSIONS", "10000")))
 PERSIST_SESSIONS = os.getenv("PERSIST_SESSIONS", "false").lower() in {"1", "true", "yes"}
 SESSION_STORE_PATH = os.getenv("SESSION_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "session_store.json"))
+# Append-only event log replayed on top of the snapshot. Events are batched for up to
+# SESSION_FLUSH_MS, fsynced every N events, and compacted into a snapshot every N seconds.
+SESSION_LOG_PATH = os.getenv("SESSION_LOG_PATH", os.path.splitext(SESSION_STORE_PATH)[0] + ".jsonl")
+SESSION_FSYNC_EVERY = max(1, int(os.getenv("SESSION_FSYNC_EVERY", "32")))
+SESSION_FLUSH_DELAY = int(os.getenv("SESSION_FLUSH_MS", "500")) / 1000.0
+SESSION_COMPACT_INTERVAL = float(os.getenv("SESSION_COMPACT_INTERVAL", "30"))
 
 # Load default system prompt from file if available
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
@@ -40,11 +87,16 @@ try:
     if os.path.exists(SYSTEM_PROMPT_PATH):
         with open(SYSTEM_PROMPT_PATH, "r", encoding="utf-8") as f:
             DEFAULT_SYSTEM_PROMPT = f.read().strip() or DEFAULT_SYSTEM_PROMPT
-            print(f"Loaded system prompt from: {SYSTEM_PROMPT_PATH}")
+            logger.info("Loaded system prompt from: %s", SYSTEM_PROMPT_PATH)
     else:
-        print(f"System prompt file not found at: {SYSTEM_PROMPT_PATH}. Using default.")
+        logger.info("System prompt file not found at: %s. Using default.", SYSTEM_PROMPT_PATH)
 except Exception as e:
-    print(f"Failed to load system prompt from file: {e}. Using default.")
+    logger.warning("Failed to load system prompt from file: %s. Using default.", e)
+
+# /chat/stream batches token deltas and flushes once this many chars are pending or
+# the last flush is older than STREAM_FLUSH_MS, whichever comes first.
+STREAM_FLUSH_CHARS = int(os.getenv("STREAM_FLUSH_CHARS", "64"))
+STREAM_FLUSH_INTERVAL = int(os.getenv("STREAM_FLUSH_MS", "40")) / 1000.0
 
 # Optional: ask model to include a brief reasoning summary block (not chain-of-thought)
 SHOW_THINKING_SUMMARY = os.getenv("SHOW_THINKING_SUMMARY", "false").lower() in {"1", "true", "yes"}
@@ -54,30 +106,63 @@ REASONING_GUIDE = (
 
 if not OPENROUTER_API_KEY:
     # We don't raise immediately to allow the server to start and return a 500 if missing on calls.
-    print("WARNING: OPENROUTER_API_KEY not set in environment. Set it in .env as OPENROUTER_API_KEY=<your_key>.")
+    logger.warning("OPENROUTER_API_KEY not set in environment. Set it in .env as OPENROUTER_API_KEY=<your_key>.")
+
+app = FastAPI(title="Chatbot Backend", version="1.0.0", default_response_class=ORJSONResponse)
+
+# Static half of the OpenRouter request headers; Authorization is added per request.
+_BASE_HEADERS = {"Content-Type": "application/json"}
+
+# Shared async HTTP client for OpenRouter (connection-pooled, HTTP/2); created on startup.
+http_client: httpx.AsyncClient | None = None
+
 
-app = FastAPI(title="Chatbot Backend", version="1.0.0")
+@app.on_event("startup")
+async def _startup() -> None:
+    global http_client
+    http_client = httpx.AsyncClient(
+        base_url=OPENROUTER_BASE_URL,
+        http2=True,
+        timeout=httpx.Timeout(300.0),
+        # Keep idle connections (and their TLS sessions) for 5 minutes instead of httpx's 5s
+        # default, so successive chats multiplex over an already-open HTTP/2 connection.
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=50, keepalive_expiry=300),
+    )
+
+
+@app.on_event("shutdown")
+async def _shutdown() -> None:
+    if http_client is not None:
+        await http_client.aclose()
 
-# Allow Vite dev server and local clients
+# Allow Vite dev server and local clients on any port via one compiled regex, plus any
+# deployed frontends listed in CORS_ORIGINS (no "*", which is invalid alongside credentials).
+CORS_ORIGIN_REGEX = os.getenv("CORS_ORIGIN_REGEX", r"^https?://(localhost|127\.0\.0\.1|\[::1\])(:\d+)?$")
+CORS_ORIGINS = [o.strip() for o in os.getenv("CORS_ORIGINS", "").split(",") if o.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=[
-        "http://localhost:8080",
-        "http://127.0.0.1:8080",
-        "http://[::1]:8080",
-        "http://localhost:8081",
-        "http://127.0.0.1:8081",
-        "http://[::1]:8081",
-        "*"  # You may restrict this in production
-    ],
+    allow_origins=CORS_ORIGINS,
+    allow_origin_regex=CORS_ORIGIN_REGEX,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
     expose_headers=["x-session-id", "content-type"],
 )
 
+class _UploadStaticFiles(StaticFiles):
+    """StaticFiles for /uploads with far-future caching. Uploaded files are write-once under a
+    random prefix, so clients and any CDN/reverse proxy in front can keep them indefinitely
+    instead of asking Python again.
+    """
+
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("Cache-Control", "public, max-age=31536000, immutable")
+        return response
+
+
 # Static files for uploads (mounted after app and PROJECT_ROOT are defined)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+app.mount("/uploads", _UploadStaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 class ChatRequest(BaseModel):
     message: str
@@ -112,113 +197,341 @@ def root():
 # ----------------------------
 # In-memory session store
 # ----------------------------
-_SESSION_LOCK = threading.Lock()
-_SESSIONS: Dict[str, List[Dict[str, Any]]] = {}
+# Each session is a ring buffer of the last MAX_TURNS exchanges (2 messages per turn);
+# a non-positive MAX_TURNS keeps the full history.
+_HISTORY_MAXLEN = MAX_TURNS * 2 if MAX_TURNS > 0 else None
+# Ordered by recency of writes so the LRU session can be evicted in O(1).
+_SESSIONS: "OrderedDict[str, Deque[Dict[str, Any]]]" = OrderedDict()
+# Sharded per-session locks so unrelated sessions don't serialize on one global lock.
+_SHARDS = 64
+_SHARD_LOCKS = [asyncio.Lock() for _ in range(_SHARDS)]
+
+# Persistence is an append-only JSONL event log plus a periodic full snapshot.
+# _STORE_LOCK guards the log handle and snapshot rewrites independently of the shard locks.
+_STORE_LOCK = asyncio.Lock()
+_store_buffer: List[bytes] = []  # serialized events not yet written to the log
+_store_log = None  # aiofiles handle, opened on startup
+_store_unsynced = 0  # events written since the last fsync
+_store_dirty = False  # events recorded since the last snapshot
+# Every logged event carries an increasing seq and the snapshot records the last seq it
+# covers, so replay skips events already in the snapshot (e.g. after a crash between the
+# snapshot replace and the log truncate).
+_store_seq = 0
+_store_wakeup = asyncio.Event()  # set when events are queued; wakes the writer task
+_writer_task: asyncio.Task | None = None
+_compactor_task: asyncio.Task | None = None
+
+
+def _lock_for(session_id: str) -> asyncio.Lock:
+    return _SHARD_LOCKS[hash(session_id) % _SHARDS]
+
+
+def _touch(session_id: str) -> None:
+    _SESSIONS.move_to_end(session_id)
+
+
+def _evict() -> None:
+    while len(_SESSIONS) > MAX_SESSIONS:
+        _SESSIONS.popitem(last=False)
+
+
+def _history_for(session_id: str) -> Deque[Dict[str, Any]]:
+    """Return the session's history for writing, marking it most recently used."""
+    hist = _SESSIONS.get(session_id)
+    if hist is None:
+        hist = _SESSIONS[session_id] = deque(maxlen=_HISTORY_MAXLEN)
+        _evict()
+    else:
+        _touch(session_id)
+    return hist
+
+
+def _clean_message(msg: Any) -> Dict[str, str] | None:
+    """Validate a persisted message; return a {"role", "content"} copy, or None if malformed.
+    Extra keys are dropped so nothing beyond role/content is ever sent upstream.
+    """
+    if isinstance(msg, dict) and isinstance(msg.get("role"), str) and isinstance(msg.get("content"), str):
+        return {"role": msg["role"], "content": msg["content"]}
+    return None
+
+
+def _apply_event(event: Dict[str, Any]) -> None:
+    """Replay a single logged session event onto _SESSIONS."""
+    sid = event.get("sid")
+    if not isinstance(sid, str):
+        return
+    op = event.get("op")
+    if op == "clear":
+        _SESSIONS.pop(sid, None)
+    elif op == "append":
+        msg = _clean_message(event.get("msg"))
+        if msg is not None:
+            _history_for(sid).append(msg)
 
 
 def _load_sessions_from_disk() -> None:
+    """Load the last snapshot, then replay the event log entries it does not cover."""
+    global _store_seq
     if not PERSIST_SESSIONS:
         return
     try:
-        if os.path.exists(SESSION_STORE_PATH):
-            with open(SESSION_STORE_PATH, "r", encoding="utf-8") as f:
-                data = json.load(f)
+        snapshot_seq = -1  # legacy snapshot / none: replay every event
+        if os.path.exists(SESSION_STORE_PATH) and os.path.getsize(SESSION_STORE_PATH) > 0:
+            # Parse straight from an mmap'd view: no intermediate copy of the file contents
+            with open(SESSION_STORE_PATH, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    data = orjson.loads(view)
+                # Current shape is {"seq": n, "sessions": {...}}; older stores are the bare sessions dict
+                if isinstance(data, dict) and isinstance(data.get("seq"), int) and isinstance(data.get("sessions"), dict):
+                    snapshot_seq = data["seq"]
+                    data = data["sessions"]
                 if isinstance(data, dict):
-                    with _SESSION_LOCK:
-                        # ensure correct shape
-                        for k, v in data.items():
-                            if isinstance(v, list):
-                                _SESSIONS[k] = [m for m in v if isinstance(m, dict) and "role" in m and "content" in m]
-            print(f"Loaded sessions from {SESSION_STORE_PATH} ({len(_SESSIONS)} sessions)")
+                    # ensure correct shape
+                    for k, v in data.items():
+                        if isinstance(v, list):
+                            _SESSIONS[k] = deque(
+                                (m for m in map(_clean_message, v) if m is not None),
+                                maxlen=_HISTORY_MAXLEN,
+                            )
+        if os.path.exists(SESSION_LOG_PATH):
+            with open(SESSION_LOG_PATH, "rb") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        event = orjson.loads(line)
+                    except ValueError:
+                        # A torn final line after a crash; skip it
+                        continue
+                    if not isinstance(event, dict):
+                        continue
+                    seq = event.get("seq")
+                    seq = seq if isinstance(seq, int) else 0
+                    _store_seq = max(_store_seq, seq)
+                    if seq <= snapshot_seq:
+                        # Already contained in the snapshot
+                        continue
+                    _apply_event(event)
+        _store_seq = max(_store_seq, snapshot_seq)
+        _evict()
+        logger.info("Loaded sessions from %s (%d sessions)", SESSION_STORE_PATH, len(_SESSIONS))
     except Exception as e:
-        print(f"Failed to load sessions: {e}")
+        logger.warning("Failed to load sessions: %s", e)
+
+
+def _record_event(session_id: str, op: str, *msgs: Dict[str, Any]) -> None:
+    """Queue a session change ("append" with messages, or "clear") for the event log.
+    Called right after the in-memory mutation, with no await in between, so queued events
+    stay ordered with it; _compact_sessions relies on that. The write itself happens in
+    the background writer task, off the request path.
+    """
+    global _store_dirty, _store_seq
+    if not PERSIST_SESSIONS:
+        return
+    if op == "clear":
+        _store_seq += 1
+        _store_buffer.append(orjson.dumps({"seq": _store_seq, "sid": session_id, "op": "clear"}) + b"\n")
+    else:
+        for m in msgs:
+            _store_seq += 1
+            _store_buffer.append(orjson.dumps({"seq": _store_seq, "sid": session_id, "op": op, "msg": m}) + b"\n")
+    _store_dirty = True
+    _store_wakeup.set()
+
+
+async def _flush_store() -> None:
+    """Write all queued events to the log in one batch and flush it; fsync every SESSION_FSYNC_EVERY events."""
+    global _store_unsynced
+    async with _STORE_LOCK:
+        if not _store_buffer or _store_log is None:
+            return
+        lines = b"".join(_store_buffer)
+        count = len(_store_buffer)
+        _store_buffer.clear()
+        await _store_log.write(lines)
+        # Hand every batch to the OS right away so a process crash can't lose it;
+        # only the (costlier) fsync is batched.
+        await _store_log.flush()
+        _store_unsynced += count
+        if _store_unsynced >= SESSION_FSYNC_EVERY:
+            await asyncio.to_thread(os.fsync, _store_log.fileno())
+            _store_unsynced = 0
+
+
+async def _store_writer() -> None:
+    while True:
+        await _store_wakeup.wait()
+        # Give concurrent turns a moment to queue up so they share one write
+        await asyncio.sleep(SESSION_FLUSH_DELAY)
+        _store_wakeup.clear()
+        try:
+            await _flush_store()
+        except Exception as e:
+            logger.warning("Failed to persist sessions: %s", e)
+
+
+async def _compact_sessions() -> None:
+    """Atomically rewrite the full snapshot (tmp + os.replace) and truncate the event log."""
+    global _store_unsynced, _store_dirty
+    async with _STORE_LOCK:
+        if not _store_dirty:
+            return
+        # Take the snapshot and drop queued events in one step: they are already in it.
+        data = orjson.dumps({"seq": _store_seq, "sessions": {k: list(v) for k, v in _SESSIONS.items()}})
+        pending = list(_store_buffer)
+        _store_buffer.clear()
+        _store_dirty = False
+        try:
+            tmp_path = SESSION_STORE_PATH + ".tmp"
+            async with aiofiles.open(tmp_path, "wb") as f:
+                await f.write(data)
+                await f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+            os.replace(tmp_path, SESSION_STORE_PATH)
+        except Exception:
+            # Keep the log authoritative if the snapshot could not be written
+            _store_buffer[:0] = pending
+            _store_dirty = True
+            raise
+        if _store_log is not None:
+            await _store_log.flush()
+            await _store_log.truncate(0)
+        _store_unsynced = 0
+
+
+async def _compactor() -> None:
+    while True:
+        await asyncio.sleep(SESSION_COMPACT_INTERVAL)
+        try:
+            await _compact_sessions()
+        except Exception as e:
+            logger.warning("Failed to compact sessions: %s", e)
 
 
-def _persist_sessions_to_disk() -> None:
+@app.on_event("startup")
+async def _start_session_store() -> None:
+    global _store_log, _writer_task, _compactor_task
     if not PERSIST_SESSIONS:
         return
+    _store_log = await aiofiles.open(SESSION_LOG_PATH, "ab")
+    _writer_task = asyncio.create_task(_store_writer())
+    _compactor_task = asyncio.create_task(_compactor())
+
+
+@app.on_event("shutdown")
+async def _stop_session_store() -> None:
+    global _store_log
+    for task in (_writer_task, _compactor_task):
+        if task is not None:
+            task.cancel()
+    if _store_log is None:
+        return
     try:
-        with _SESSION_LOCK:
-            with open(SESSION_STORE_PATH, "w", encoding="utf-8") as f:
-                json.dump(_SESSIONS, f)
+        await _compact_sessions()
     except Exception as e:
-        print(f"Failed to persist sessions: {e}")
+        logger.warning("Failed to compact sessions: %s", e)
+        # Snapshot failed; at least get queued events into the log
+        try:
+            await _flush_store()
+        except Exception as e:
+            logger.warning("Failed to persist sessions: %s", e)
+    await _store_log.close()
+    _store_log = None
 
 
 _load_sessions_from_disk()
 
 
-def _build_messages(system_prompt: str, history: List[Dict[str, Any]], user_message: str) -> List[Dict[str, str]]:
+# The common case is the default prompt, so both of its variants are built once here.
+# Client-supplied prompts are built per request and not cached: caching them would let
+# any caller pin arbitrarily large strings in memory.
+_DEFAULT_PROMPT_WITH_GUIDE = (DEFAULT_SYSTEM_PROMPT + REASONING_GUIDE).strip()
+
+
+def _assemble_system_prompt(system_prompt: str, want_summary: bool) -> str:
+    if system_prompt == DEFAULT_SYSTEM_PROMPT:
+        return _DEFAULT_PROMPT_WITH_GUIDE if want_summary else DEFAULT_SYSTEM_PROMPT
+    return (system_prompt + REASONING_GUIDE).strip() if want_summary else system_prompt
+
+
+# Prebuilt system messages for the default prompts; shared across requests, which is safe
+# because outbound serialization never mutates them.
+_DEFAULT_SYSTEM_MESSAGES = {
+    p: {"role": "system", "content": p} for p in (DEFAULT_SYSTEM_PROMPT, _DEFAULT_PROMPT_WITH_GUIDE)
+}
+
+
+def _system_message(system_prompt: str) -> Dict[str, str]:
+    msg = _DEFAULT_SYSTEM_MESSAGES.get(system_prompt)
+    return msg if msg is not None else {"role": "system", "content": system_prompt}
+
+
+def _build_messages(system_prompt: str, history: Sequence[Dict[str, Any]], user_message: str) -> List[Dict[str, str]]:
     """Build messages with limits to keep prompts fast.
     Applies both MAX_TURNS (last N exchanges) and MAX_PROMPT_CHARS (approx cap by char count).
     """
+    # Fast path for the most common shape: a fresh session with no history yet
+    if not history:
+        return [_system_message(system_prompt), {"role": "user", "content": user_message}]
+
     # First, apply turns cap (2 messages per turn)
     max_messages = MAX_TURNS * 2
     trimmed_hist = history[-max_messages:] if max_messages > 0 else history
 
-    # Then, apply character budget from the end (most recent first)
+    # Then, apply character budget from the end (most recent first): running totals over the
+    # newest messages only grow, so bisect finds how many fit.
     budget = max(1000, MAX_PROMPT_CHARS)  # never below 1000 chars
-    accum: List[Dict[str, str]] = []
-    total = 0
-    for msg in reversed(trimmed_hist):
-        content = str(msg.get("content", ""))
-        # Always include at least a small piece of the last few messages
-        if total + len(content) > budget and len(accum) > 0:
-            break
-        accum.append({"role": msg.get("role", "user"), "content": content})
-        total += len(content)
-    accum.reverse()
+    totals = list(accumulate(len(m["content"]) for m in reversed(trimmed_hist)))
+    # Always include at least the most recent message
+    keep = max(1, bisect_right(totals, budget)) if totals else 0
+    # Stored messages are already {"role", "content"} dicts; reuse them as-is
+    accum = trimmed_hist[-keep:] if keep else ()
 
     messages = [
-        {"role": "system", "content": system_prompt},
+        _system_message(system_prompt),
         *accum,
         {"role": "user", "content": user_message},
     ]
     return messages
 
 
-@app.post("/chat", response_model=ChatResponse)
-def chat(req: ChatRequest):
+# ChatResponse documents the schema only; replies are returned as ORJSONResponse to skip validation.
+@app.post("/chat", responses={200: {"model": ChatResponse}})
+async def chat(req: ChatRequest):
     # Prefer request-provided key, fall back to environment.
     request_api_key = (req.api_key or "").strip()
     effective_api_key = request_api_key or OPENROUTER_API_KEY
     if not effective_api_key:
         raise HTTPException(status_code=400, detail="OpenRouter API key is required. Provide it in the request (api_key) or set OPENROUTER_API_KEY on the server.")
 
-    system_prompt = req.system_prompt or DEFAULT_SYSTEM_PROMPT
     want_summary = req.show_thinking_summary if req.show_thinking_summary is not None else SHOW_THINKING_SUMMARY
-    if want_summary:
-        system_prompt = (system_prompt + REASONING_GUIDE).strip()
+    system_prompt = _assemble_system_prompt(req.system_prompt or DEFAULT_SYSTEM_PROMPT, want_summary)
 
-    # Determine session id (allow client-provided or generate deterministic per-process)
-    session_id = req.session_id or os.urandom(8).hex()
+    # Determine session id (allow client-provided or generate a random one)
+    session_id = req.session_id or secrets.token_hex(8)
 
     # Allow pure clear without invoking the model when message is empty
     if req.clear and not (req.message or "").strip():
-        with _SESSION_LOCK:
+        async with _lock_for(session_id):
             _SESSIONS.pop(session_id, None)
-            _persist_sessions_to_disk()
-        def _gen():
+            _record_event(session_id, "clear")
+        async def _gen():
             yield "Memory cleared."
         return StreamingResponse(_gen(), media_type="text/plain", headers={"x-session-id": session_id})
 
     # Clear session on demand
     if req.clear:
-        with _SESSION_LOCK:
+        async with _lock_for(session_id):
             _SESSIONS.pop(session_id, None)
-            _persist_sessions_to_disk()
+            _record_event(session_id, "clear")
         # If this is a pure clear action (no message), return immediately without calling the model
         if not (req.message or "").strip():
-            return ChatResponse(reply="Memory cleared.", session_id=session_id)
+            return ORJSONResponse({"reply": "Memory cleared.", "session_id": session_id})
 
-    url = f"{OPENROUTER_BASE_URL}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {effective_api_key}",
-        "Content-Type": "application/json",
-    }
+    headers = {**_BASE_HEADERS, "Authorization": f"Bearer {effective_api_key}"}
     # Build conversation from history (trimmed for speed)
-    with _SESSION_LOCK:
-        history = _SESSIONS.get(session_id, []).copy()
+    async with _lock_for(session_id):
+        history = tuple(_SESSIONS.get(session_id, ()))
     messages = _build_messages(system_prompt, history, req.message)
     payload = {
         "model": (req.model or OPENROUTER_MODEL),
@@ -231,28 +544,29 @@ def chat(req: ChatRequest):
             payload["temperature"] = float(req.temperature)
         except Exception:
             pass
+    # Serialize once with orjson and send raw bytes, skipping httpx's stdlib json path
+    body = orjson.dumps(payload)
 
     try:
-        r = requests.post(url, headers=headers, json=payload, timeout=60)
+        r = await http_client.post("/chat/completions", headers=headers, content=body, timeout=60)
+        raw = r.content
         if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.text)
-        data = r.json()
-        reply = data.get("choices", [{}])[0].get("message", {}).get("content")
+            raise HTTPException(status_code=r.status_code, detail=raw[:4096].decode("utf-8", "replace"))
+        data = orjson.loads(raw)
+        try:
+            reply = data["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            reply = None
         if not reply:
             raise HTTPException(status_code=502, detail="No reply from model")
         # Update history (keep last MAX_TURNS exchanges)
-        with _SESSION_LOCK:
-            hist = _SESSIONS.get(session_id, [])
+        async with _lock_for(session_id):
+            hist = _history_for(session_id)
             hist.append({"role": "user", "content": req.message})
             hist.append({"role": "assistant", "content": reply})
-            # Trim to last exchanges (2 messages per turn)
-            max_messages = MAX_TURNS * 2
-            if len(hist) > max_messages:
-                hist = hist[-max_messages:]
-            _SESSIONS[session_id] = hist
-            _persist_sessions_to_disk()
-        return ChatResponse(reply=reply, session_id=session_id)
-    except requests.RequestException as e:
+            _record_event(session_id, "append", hist[-2], hist[-1])
+        return ORJSONResponse({"reply": reply, "session_id": session_id})
+    except (httpx.HTTPError, orjson.JSONDecodeError) as e:
         raise HTTPException(status_code=502, detail=str(e))
 
 
@@ -262,40 +576,36 @@ async def upload(files: List[UploadFile] = File(...)):
     Intended for images and documents. Files are saved with a random prefix to avoid collisions.
     Enforces simple size and content-type checks configurable via env.
     """
-    # Upload constraints (configurable via env)
-    try:
-        max_mb = max(1, int(os.getenv("MAX_UPLOAD_SIZE_MB", "10")))
-    except Exception:
-        max_mb = 10
-    MAX_BYTES = max_mb * 1024 * 1024
-    allowed_types_env = os.getenv(
-        "ALLOWED_UPLOAD_TYPES",
-        # common images and office/pdf/plain text
-        "image/jpeg,image/png,image/gif,application/pdf,application/vnd.openxmlformats-officedocument.wordprocessingml.document,application/msword,text/plain"
-    )
-    ALLOWED_TYPES = {t.strip().lower() for t in allowed_types_env.split(",") if t.strip()}
-
     saved = []
     for f in files:
         # Sanitize filename
         name = os.path.basename(f.filename or "file")
-        prefix = os.urandom(4).hex()
+        prefix = secrets.token_hex(4)
         out_name = f"{prefix}_{name}"
         out_path = os.path.join(UPLOAD_DIR, out_name)
         try:
-            content = await f.read()
-            size = len(content)
             ctype = (f.content_type or "").lower().strip()
 
-            if size > MAX_BYTES:
-                raise HTTPException(status_code=413, detail=f"{name}: file too large ({size} bytes). Max {max_mb} MB")
-
             # If a type is provided, ensure it's allowed (skip check if backend cannot detect type)
-            if ctype and ALLOWED_TYPES and ctype not in ALLOWED_TYPES:
+            if ctype and ALLOWED_UPLOAD_TYPES and ctype not in ALLOWED_UPLOAD_TYPES:
                 raise HTTPException(status_code=415, detail=f"{name}: content-type '{ctype}' not allowed")
 
-            with open(out_path, "wb") as out:
-                out.write(content)
+            # Starlette records the parsed size; reject known-oversized files before writing anything
+            if f.size is not None and f.size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=f"{name}: file too large ({f.size} bytes). Max {MAX_UPLOAD_SIZE_MB} MB")
+
+            # Stream to disk chunk by chunk so memory stays bounded regardless of file size
+            size = 0
+            async with aiofiles.open(out_path, "wb") as out:
+                while chunk := await f.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_BYTES:
+                        break
+                    await out.write(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                os.remove(out_path)
+                raise HTTPException(status_code=413, detail=f"{name}: file too large (over {MAX_UPLOAD_BYTES} bytes). Max {MAX_UPLOAD_SIZE_MB} MB")
+
             saved.append({
                 "name": name,
                 "stored_name": out_name,
@@ -311,8 +621,46 @@ async def upload(files: List[UploadFile] = File(...)):
     return {"files": saved}
 
 
+async def _read_sse_text(resp: httpx.Response, pieces: asyncio.Queue, reply_accum: List[str]) -> None:
+    """Parse an OpenRouter SSE byte stream and put each text piece on the queue.
+    Content deltas are also collected into reply_accum. Puts None when the stream ends,
+    or the exception if reading fails.
+    """
+    try:
+        # Split the raw byte stream into lines ourselves; no per-line decode
+        buf = bytearray()
+        async for raw in resp.aiter_bytes():
+            buf += raw
+            start = 0
+            while (nl := buf.find(b"\n", start)) >= 0:
+                line = buf[start:nl]
+                start = nl + 1
+                # OpenRouter streams Server-Sent Events lines starting with 'data: '
+                if not line.startswith(b"data: "):
+                    continue
+                data = line[6:].strip()
+                if data == b"[DONE]":
+                    pieces.put_nowait(None)
+                    return
+                try:
+                    obj = orjson.loads(data)
+                    delta = obj.get("choices", [{}])[0].get("delta", {})
+                    chunk = delta.get("content")
+                    if chunk:
+                        reply_accum.append(chunk)
+                        pieces.put_nowait(chunk)
+                except Exception:
+                    # If not JSON (rare), just forward text
+                    pieces.put_nowait(data.decode("utf-8", "replace"))
+            # Keep only the trailing partial line for the next chunk
+            del buf[:start]
+        pieces.put_nowait(None)
+    except Exception as e:
+        pieces.put_nowait(e)
+
+
 @app.post("/chat/stream")
-def chat_stream(req: ChatRequest):
+async def chat_stream(req: ChatRequest):
     """Stream assistant response tokens progressively, ChatGPT-style.
     The response body is a text stream (chunked). A header 'x-session-id' is set.
     """
@@ -322,21 +670,15 @@ def chat_stream(req: ChatRequest):
     if not effective_api_key:
         raise HTTPException(status_code=400, detail="OpenRouter API key is required. Provide it in the request (api_key) or set OPENROUTER_API_KEY on the server.")
 
-    system_prompt = req.system_prompt or DEFAULT_SYSTEM_PROMPT
-    if SHOW_THINKING_SUMMARY:
-        system_prompt = (system_prompt + REASONING_GUIDE).strip()
-    session_id = req.session_id or os.urandom(8).hex()
+    system_prompt = _assemble_system_prompt(req.system_prompt or DEFAULT_SYSTEM_PROMPT, SHOW_THINKING_SUMMARY)
+    session_id = req.session_id or secrets.token_hex(8)
 
     # Build conversation from history (trimmed for speed)
-    with _SESSION_LOCK:
-        history = _SESSIONS.get(session_id, []).copy()
+    async with _lock_for(session_id):
+        history = tuple(_SESSIONS.get(session_id, ()))
     messages = _build_messages(system_prompt, history, req.message)
 
-    url = f"{OPENROUTER_BASE_URL}/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {effective_api_key}",
-        "Content-Type": "application/json",
-    }
+    headers = {**_BASE_HEADERS, "Authorization": f"Bearer {effective_api_key}"}
     payload = {
         "model": (req.model or OPENROUTER_MODEL),
         "messages": messages,
@@ -349,48 +691,73 @@ def chat_stream(req: ChatRequest):
             payload["temperature"] = float(req.temperature)
         except Exception:
             pass
+    body = orjson.dumps(payload)
 
-    def event_generator():
+    async def event_generator():
         reply_accum = []
+        # Coalesce small deltas into fewer, larger writes (flushed by size or age)
+        loop = asyncio.get_running_loop()
+        out: List[str] = []
+        out_len = 0
+        last_flush = loop.time()
         try:
             # Basic retry loop for connection setup issues (e.g., DNS)
             last_err: Exception | None = None
             for attempt in range(1, 4):
                 try:
-                    with requests.post(url, headers=headers, json=payload, stream=True, timeout=300) as resp:
+                    async with http_client.stream("POST", "/chat/completions", headers=headers, content=body) as resp:
                         if resp.status_code != 200:
+                            await resp.aread()
                             yield f"[ERROR] Upstream error {resp.status_code}: {resp.text}"
                             return
-                        for line in resp.iter_lines(decode_unicode=True):
-                            if not line:
-                                continue
-                            # OpenRouter streams Server-Sent Events lines starting with 'data: '
-                            if line.startswith("data: "):
-                                data_str = line[len("data: "):].strip()
-                                if data_str == "[DONE]":
-                                    break
+                        # A reader task parses the stream into a queue, so pending text can be
+                        # flushed on a timer even while upstream is silent (e.g. reasoning pauses).
+                        pieces: asyncio.Queue = asyncio.Queue()
+                        reader = asyncio.create_task(_read_sse_text(resp, pieces, reply_accum))
+                        try:
+                            while True:
+                                timeout = None
+                                if out:
+                                    timeout = max(0.0, STREAM_FLUSH_INTERVAL - (loop.time() - last_flush))
                                 try:
-                                    obj = json.loads(data_str)
-                                    delta = obj.get("choices", [{}])[0].get("delta", {})
-                                    chunk = delta.get("content")
-                                    if chunk:
-                                        reply_accum.append(chunk)
-                                        yield chunk
-                                except Exception:
-                                    # If not JSON (rare), just forward text
-                                    yield data_str
+                                    item = await asyncio.wait_for(pieces.get(), timeout)
+                                except asyncio.TimeoutError:
+                                    item = ""  # flush deadline reached
+                                if item is None:
+                                    break
+                                if isinstance(item, Exception):
+                                    raise item
+                                if item:
+                                    out.append(item)
+                                    out_len += len(item)
+                                now = loop.time()
+                                if out and (out_len >= STREAM_FLUSH_CHARS or now - last_flush >= STREAM_FLUSH_INTERVAL):
+                                    yield "".join(out)
+                                    out.clear()
+                                    out_len = 0
+                                    last_flush = now
+                        finally:
+                            reader.cancel()
+                        if out:
+                            yield "".join(out)
+                            out.clear()
                         # If we reached here without exception, break out of retry loop
                         last_err = None
                         break
-                except requests.RequestException as e:
+                except httpx.HTTPError as e:
                     last_err = e
+                    # Deliver whatever was already received before retrying or reporting the error
+                    if out:
+                        yield "".join(out)
+                        out.clear()
+                        out_len = 0
                     # Exponential backoff before retrying
                     if attempt < 3:
-                        time.sleep(0.6 * (2 ** (attempt - 1)))
+                        await asyncio.sleep(0.6 * (2 ** (attempt - 1)))
                     else:
                         # On final failure, emit a friendly error to the client
                         msg = str(e)
-                        if 'getaddrinfo failed' in msg or 'NameResolutionError' in msg:
+                        if 'getaddrinfo failed' in msg or 'Name or service not known' in msg:
                             yield "[ERROR] Cannot resolve OpenRouter host. Check your internet/DNS or OPENROUTER_BASE_URL."
                         else:
                             yield f"[ERROR] Network error: {msg}"
@@ -399,30 +766,42 @@ def chat_stream(req: ChatRequest):
             # Persist history after stream completes
             full_reply = "".join(reply_accum).strip()
             if full_reply:
-                with _SESSION_LOCK:
-                    hist = _SESSIONS.get(session_id, [])
+                async with _lock_for(session_id):
+                    hist = _history_for(session_id)
                     hist.append({"role": "user", "content": req.message})
                     hist.append({"role": "assistant", "content": full_reply})
-                    max_messages = MAX_TURNS * 2
-                    if len(hist) > max_messages:
-                        hist = hist[-max_messages:]
-                    _SESSIONS[session_id] = hist
-                    _persist_sessions_to_disk()
+                    _record_event(session_id, "append", hist[-2], hist[-1])
 
     return StreamingResponse(event_generator(), media_type="text/plain", headers={"x-session-id": session_id})
 
 
 def _strip_html(text: str) -> str:
-    # very simple tag stripper
-    text = re.sub(r"<script[\s\S]*?</script>", " ", text, flags=re.I)
-    text = re.sub(r"<style[\s\S]*?</style>", " ", text, flags=re.I)
-    text = re.sub(r"<[^>]+>", " ", text)
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    # Parse with selectolax (C-based Lexbor) rather than regex; linear in document size
+    tree = HTMLParser(text)
+    for node in tree.css("script,style"):
+        node.decompose()
+    root = tree.body or tree.root
+    if root is None:
+        return ""
+    return " ".join(root.text(separator=" ").split())
+
+
+async def _fetch_page_text(href: str, sem: asyncio.Semaphore) -> str:
+    # Only absolute URLs: relative ones would resolve against the OpenRouter base_url
+    if not href.startswith(("http://", "https://")):
+        return ""
+    async with sem:
+        try:
+            pr = await http_client.get(href, timeout=10, headers={"User-Agent": "Mozilla/5.0"}, follow_redirects=True)
+            if pr.status_code == 200:
+                return _strip_html(pr.text)[:2000]
+        except Exception:
+            pass
+    return ""
 
 
 @app.post("/websearch")
-def websearch(payload: dict):
+async def websearch(payload: dict):
     """
     Body: { "query": str, "max_results": int=5 }
     Uses Tavily if TAVILY_API_KEY is present; otherwise, falls back to DuckDuckGo.
@@ -447,9 +826,9 @@ def websearch(payload: dict):
                 "include_images": False,
                 "include_domains": [],
             }
-            r = requests.post(tavily_url, headers=headers, json=data, timeout=30)
+            r = await http_client.post(tavily_url, headers=headers, json=data, timeout=30)
             if r.status_code == 200:
-                jr = r.json()
+                jr = orjson.loads(r.content)
                 for item in jr.get("results", [])[:max_results]:
                     results.append({
                         "title": item.get("title") or item.get("url") or "",
@@ -462,30 +841,42 @@ def websearch(payload: dict):
     # Fallback to DuckDuckGo Lite HTML if no results yet
     if not results:
         try:
-            q = requests.utils.quote(query)
+            q = quote_plus(query)
             url = f"https://duckduckgo.com/html/?q={q}"
-            r = requests.get(url, timeout=20, headers={"User-Agent": "Mozilla/5.0"})
+            r = await http_client.get(url, timeout=20, headers={"User-Agent": "Mozilla/5.0"}, follow_redirects=True)
             if r.status_code == 200:
-                # crude parse for results
-                links = re.findall(r'<a[^>]+class="result__a"[^>]*href="([^"]+)"[^>]*>(.*?)</a>', r.text, flags=re.I)
-                for href, title_html in links[:max_results]:
-                    title = _strip_html(title_html)
-                    content = ""
-                    try:
-                        pr = requests.get(href, timeout=10, headers={"User-Agent": "Mozilla/5.0"})
-                        if pr.status_code == 200:
-                            content = _strip_html(pr.text)[:2000]
-                    except Exception:
-                        pass
+                # Result links are <a class="result__a" href=...>title</a>
+                links = []
+                for a in HTMLParser(r.text).css("a.result__a"):
+                    href = a.attributes.get("href")
+                    if href:
+                        links.append((href, " ".join(a.text(separator=" ").split())))
+                    if len(links) >= max_results:
+                        break
+                # Fetch result pages concurrently (bounded) instead of one after another
+                sem = asyncio.Semaphore(8)
+                contents = await asyncio.gather(*(_fetch_page_text(href, sem) for href, _ in links))
+                for (href, title), content in zip(links, contents):
                     results.append({"title": title, "url": href, "content": content})
         except Exception:
             pass
 
-    return JSONResponse({"results": results[:max_results]})
+    return ORJSONResponse({"results": results[:max_results]})
 
 
 if __name__ == "__main__":
     import uvicorn
 
     port = int(os.getenv("PORT", "8001"))
-    uvicorn.run("server:app", host="0.0.0.0", port=port, reload=True)
+    # Sessions live in process memory and share one on-disk log, so keep a single worker
+    # unless clients are pinned to a worker (or sessions are moved out of process).
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=port,
+        workers=int(os.getenv("WORKERS", "1")),
+        # loop/http stay at uvicorn's "auto": uvloop and httptools when installed
+        # (uvicorn[standard] on non-Windows), stdlib asyncio and h11 otherwise.
+        reload=os.getenv("RELOAD", "false").lower() in {"1", "true", "yes"},
+        log_level="warning",
+    )